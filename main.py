@@ -1,12 +1,22 @@
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
 import requests
+import httpx
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-import json
+import asyncio
 import logging
 import os
+import sqlite3
 import time
 import datetime
+import itertools
+from collections.abc import Iterator
+from contextlib import closing
+from dataclasses import dataclass
+from operator import itemgetter
 from dotenv import load_dotenv
 
 logging.basicConfig(
@@ -14,48 +24,87 @@ logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s",
     handlers=[logging.FileHandler("new_music_checker.log"), logging.StreamHandler()],
 )
-
-
+logging.getLogger("httpx").setLevel(logging.WARNING)
+log = logging.getLogger("new_music_checker")
+
+MAX_CONCURRENT_REQUESTS = 16
+MAX_CONNECTIONS = 16
+MAX_RATE_LIMIT_RETRIES = 3
+MAX_EMBEDS_PER_MESSAGE = 10
+SPOTIFY_API_URL = "https://api.spotify.com/v1/"
+RELEASE_GROUPS = ("album", "single", "compilation", "appears_on")
+RELEASES_DB = "releases.db"
+RELEASES_FILE = "releases.jsonl"
+LEGACY_RELEASES_FILE = "releases.json"
+ARTISTS_CACHE_FILE = "artists.json"
+ARTISTS_CACHE_TTL = datetime.timedelta(hours=6)
+
+
+@dataclass(slots=True, frozen=True)
 class Artist:
-    def __init__(
-        self,
-        id: str,
-        name: str,
-        spotify_url: str,
-    ):
-        self.id = id
-        self.name = name
-        self.spotify_url = spotify_url
+    id: str
+    name: str
+    spotify_url: str
 
     def __repr__(self):
         return f"{self.name} ({self.spotify_url})"
 
 
+@dataclass(slots=True, frozen=True)
 class Release:
-    def __init__(
-        self,
-        id: str,
-        artist_name: str,
-        spotify_url: str,
-        release_date: str,
-        release_type: str = None,
-    ):
-        self.id = id
-        self.artist_name = artist_name
-        self.spotify_url = spotify_url
-        self.release_date = release_date
-        self.release_type = release_type
+    id: str
+    artist_name: str
+    spotify_url: str
+    release_date: str
+    release_type: str | None = None
 
     def __repr__(self):
         return f"{self.release_date} ({self.spotify_url})"
 
 
+class RateLimiter:
+    def __init__(self, max_concurrent: int):
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.paused_at = 0.0
+        self.resume_at = 0.0
+
+    def pause(self, seconds: float):
+        now = time.monotonic()
+        if now + seconds > self.resume_at:
+            self.paused_at = now
+            self.resume_at = now + seconds
+
+    async def wait(self):
+        while (delay := self.resume_at - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+
+def create_session(retry: Retry, pool_maxsize: int = 10) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retry
+    )
+    session.mount("https://", adapter)
+    return session
+
+
 def get_spotify_client() -> spotipy.Spotify:
     scope = "user-follow-read"
     auth_manager = SpotifyOAuth(
         scope=scope,
     )
-    sp = spotipy.Spotify(auth_manager=auth_manager, requests_timeout=10)
+    sp = spotipy.Spotify(
+        auth_manager=auth_manager,
+        requests_session=create_session(
+            Retry(
+                total=10,
+                backoff_factor=0.3,
+                status_forcelist=[429, 500, 502, 503, 504],
+                respect_retry_after_header=True,
+            )
+        ),
+        requests_timeout=10,
+    )
     return sp
 
 
@@ -67,164 +116,322 @@ def create_artist_from_data(artist_data: dict) -> Artist:
     )
 
 
-def create_release_from_data(release_data: dict, artist_name: str) -> Release:
-    return Release(
-        id=release_data["id"],
-        artist_name=artist_name,
-        spotify_url=release_data["external_urls"]["spotify"],
-        release_date=release_data["release_date"],
-        release_type=release_data["album_type"],
-    )
-
-
 def get_following_artists(sp: spotipy.Spotify) -> list[Artist]:
-    followed_artists_data = fetch_all_followed_artists(sp)
-    return [create_artist_from_data(artist) for artist in followed_artists_data]
+    artists = load_artists_from_cache()
+    if artists is not None:
+        log.info("Loaded followed artists from %s", ARTISTS_CACHE_FILE)
+        return artists
 
+    followed_artists_data = fetch_all_followed_artists(sp)
+    artists = list(
+        {
+            artist["id"]: create_artist_from_data(artist)
+            for artist in followed_artists_data
+        }.values()
+    )
+    if artists:
+        save_artists_to_cache(artists)
+    return artists
 
-def fetch_all_followed_artists(sp: spotipy.Spotify) -> list[dict]:
-    results = sp.current_user_followed_artists(limit=50)
-    all_artists = results["artists"]["items"]
-    next_page = results["artists"]["next"]
 
-    retry_count = 0
-    MAX_RETRIES = 5
+def load_artists_from_cache() -> list[Artist] | None:
+    if not os.path.exists(ARTISTS_CACHE_FILE):
+        return None
 
-    while retry_count < MAX_RETRIES and next_page:
+    with open(ARTISTS_CACHE_FILE, "rb") as file:
         try:
-            results = sp.next(results["artists"])
-            next_page = results["artists"]["next"]
-            all_artists.extend(results["artists"]["items"])
-        except requests.exceptions.ConnectionError as e:
-            logging.error(f"Connection error: {e}")
-            retry_count += 1
-            time.sleep(1)
-            if retry_count >= MAX_RETRIES:
-                logging.error("Max retries reached. Exiting.")
-                break
-
-    return all_artists
-
-
-def save_releases_to_file(releases: list[Release]):
-    releases_record = []
-    for release in releases:
-        releases_record.append(
-            {
-                "id": release.id,
-                "artist_name": release.artist_name,
-                "spotify_url": release.spotify_url,
-                "release_date": release.release_date,
-                "release_type": release.release_type,
-            }
+            cache = orjson.loads(file.read())
+        except orjson.JSONDecodeError as e:
+            log.error("Invalid %s: %s", ARTISTS_CACHE_FILE, e)
+            return None
+
+    try:
+        fetched_at = datetime.datetime.fromisoformat(cache["fetched_at"])
+        age = datetime.datetime.now(datetime.timezone.utc) - fetched_at
+        if age > ARTISTS_CACHE_TTL:
+            return None
+        return [Artist(**artist) for artist in cache["artists"]] or None
+    except (KeyError, TypeError, ValueError) as e:
+        log.error("Invalid %s: %s", ARTISTS_CACHE_FILE, e)
+        return None
+
+
+def save_artists_to_cache(artists: list[Artist]):
+    cache = {
+        "fetched_at": datetime.datetime.now(datetime.timezone.utc),
+        "artists": artists,
+    }
+    with open(ARTISTS_CACHE_FILE, "wb") as file:
+        file.write(orjson.dumps(cache))
+
+
+def fetch_all_followed_artists(sp: spotipy.Spotify) -> Iterator[dict]:
+    results = sp.current_user_followed_artists(limit=50)
+    yield from results["artists"]["items"]
+    while results["artists"]["next"]:
+        results = sp.next(results["artists"])
+        yield from results["artists"]["items"]
+
+
+def connect_releases_db() -> sqlite3.Connection:
+    conn = sqlite3.connect(RELEASES_DB)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS releases ("
+        "id TEXT PRIMARY KEY, "
+        "artist_name TEXT, "
+        "spotify_url TEXT, "
+        "release_date TEXT, "
+        "release_type TEXT)"
+    )
+    if conn.execute("SELECT 1 FROM releases LIMIT 1").fetchone() is None:
+        import_legacy_releases(conn)
+    return conn
+
+
+def load_legacy_release_records() -> Iterator[dict]:
+    if os.path.exists(RELEASES_FILE):
+        with open(RELEASES_FILE, "rb") as file:
+            for line in file:
+                if line.strip():
+                    yield orjson.loads(line)
+    elif os.path.exists(LEGACY_RELEASES_FILE):
+        with open(LEGACY_RELEASES_FILE, "rb") as file:
+            yield from orjson.loads(file.read())
+
+
+def import_legacy_releases(conn: sqlite3.Connection):
+    with conn:
+        cursor = conn.executemany(
+            "INSERT OR IGNORE INTO releases VALUES "
+            "(:id, :artist_name, :spotify_url, :release_date, :release_type)",
+            load_legacy_release_records(),
         )
-    with open("releases.json", "w") as file:
-        json.dump(releases_record, file)
-    logging.info("Releases saved to releases.json")
+    if cursor.rowcount > 0:
+        log.info("Imported %d releases into %s", cursor.rowcount, RELEASES_DB)
+
+
+def is_known_release(conn: sqlite3.Connection, release_id: str) -> bool:
+    cursor = conn.execute("SELECT 1 FROM releases WHERE id = ?", (release_id,))
+    return cursor.fetchone() is not None
+
+
+def add_releases_to_db(conn: sqlite3.Connection, releases: list[Release]):
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO releases VALUES (?, ?, ?, ?, ?)",
+            (
+                (
+                    release.id,
+                    release.artist_name,
+                    release.spotify_url,
+                    release.release_date,
+                    release.release_type,
+                )
+                for release in releases
+            ),
+        )
+    log.info("Releases saved to %s", RELEASES_DB)
 
 
-def add_new_releases_to_file(releases: list[Release]):
-    releases_record = load_releases_from_file()
-    for release in releases:
-        releases_record.append(release)
-    save_releases_to_file(releases_record)
+class SpotifyAuth(httpx.Auth):
+    def __init__(self, auth_manager: SpotifyOAuth):
+        self.auth_manager = auth_manager
 
+    def auth_flow(self, request: httpx.Request):
+        token = self.auth_manager.get_access_token(as_dict=False)
+        request.headers["Authorization"] = f"Bearer {token}"
+        yield request
 
-def load_releases_from_file() -> list[Release]:
-    if not os.path.exists("releases.json"):
-        logging.info("No releases.json file found.")
-        return []
 
-    with open("releases.json", "r") as file:
-        releases_record = json.load(file)
+def create_spotify_http_client(sp: spotipy.Spotify) -> httpx.AsyncClient:
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(
+            max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS
+        ),
+    )
+    return httpx.AsyncClient(
+        base_url=SPOTIFY_API_URL,
+        auth=SpotifyAuth(sp.auth_manager),
+        timeout=10.0,
+        transport=transport,
+    )
+
+
+async def fetch_spotify_page(
+    client: httpx.AsyncClient,
+    limiter: RateLimiter,
+    url: str,
+    params: dict | None = None,
+) -> dict:
+    retries = 0
+    while True:
+        async with limiter.semaphore:
+            await limiter.wait()
+            sent_at = time.monotonic()
+            response = await client.get(url, params=params)
+        if response.status_code == 429 and retries < MAX_RATE_LIMIT_RETRIES:
+            # A 429 for a request sent before the current pause began was
+            # caused by the same app-wide limit, so it doesn't use up a retry.
+            if sent_at >= limiter.paused_at:
+                retries += 1
+            retry_after = float(response.headers.get("Retry-After", 1))
+            log.warning("Rate limited by Spotify. Retrying in %gs.", retry_after)
+            limiter.pause(retry_after)
+            continue
+        response.raise_for_status()
+        return response.json()
+
+
+async def fetch_artist_albums(
+    client: httpx.AsyncClient,
+    limiter: RateLimiter,
+    artist_id: str,
+    yesterday: str,
+) -> list[dict]:
+    # This relies on Spotify returning the groups in RELEASE_GROUPS order, each
+    # newest first: once a page ends on an old item, the rest of that group
+    # can't qualify, so only the groups after it are requested next.
+    url = f"artists/{artist_id}/albums"
+    groups = list(RELEASE_GROUPS)
+    params = {"include_groups": ",".join(groups), "limit": 50}
+    albums = []
+    while True:
+        page = await fetch_spotify_page(client, limiter, url, params)
+        albums.extend(page["items"])
+        if not page["items"] or not page["next"]:
+            return albums
+        last = page["items"][-1]
+        if last["release_date"] >= yesterday:
+            url, params = page["next"], None
+            continue
+        groups = groups[groups.index(last["album_group"]) + 1 :]
+        if not groups:
+            return albums
+        url = f"artists/{artist_id}/albums"
+        params = {"include_groups": ",".join(groups), "limit": 50}
+
+
+async def fetch_artist_new_releases(
+    client: httpx.AsyncClient,
+    limiter: RateLimiter,
+    artist: Artist,
+    yesterday: str,
+    seen_album_ids: set[str],
+) -> list[Release]:
+    try:
+        latest_items = await fetch_artist_albums(
+            client, limiter, artist.id, yesterday
+        )
+    except httpx.TimeoutException as e:
+        log.error("Timeout error fetching releases for %s: %s", artist.name, e)
+        return []
+    except httpx.TransportError as e:
+        log.error("Error fetching releases for %s: %s", artist.name, e)
+        return []
+    except httpx.HTTPStatusError as e:
+        log.error("Spotify error fetching releases for %s: %s", artist.name, e)
+        return []
+    except ValueError as e:
+        log.error("Invalid response fetching releases for %s: %s", artist.name, e)
+        return []
 
-    releases = []
-    for record in releases_record:
-        releases.append(
+    new_releases = []
+    artist_name = artist.name
+    albums = sorted(latest_items, key=itemgetter("release_date"), reverse=True)
+    for album in albums:
+        release_date = album["release_date"]
+        if release_date < yesterday:
+            break
+        album_id = album["id"]
+        if album_id in seen_album_ids:
+            continue
+        seen_album_ids.add(album_id)
+        new_releases.append(
             Release(
-                id=record["id"],
-                artist_name=record["artist_name"],
-                spotify_url=record["spotify_url"],
-                release_date=record["release_date"],
-                release_type=record["release_type"],
+                album_id,
+                artist_name,
+                album["external_urls"]["spotify"],
+                release_date,
+                album["album_type"],
             )
         )
-    return releases
-
-
-def contains_release(releases_record: list[Release], release: Release) -> bool:
-    for record in releases_record:
-        if record.id == release.id:
-            return True
-    return False
-
-
-def check_if_new_release(releases_record: list[Release], release: Release) -> bool:
-    return not contains_release(releases_record, release)
+    return new_releases
 
 
-def get_following_artists_new_releases(sp: spotipy.Spotify) -> list:
-    artists = get_following_artists(sp)
+async def get_following_artists_new_releases(
+    sp: spotipy.Spotify, artists: list[Artist]
+) -> list:
     if not artists:
         return []
-    new_releases = []
-    yesterday = (datetime.datetime.now() - datetime.timedelta(days=1)).strftime("%Y-%m-%d")
-    for artist in artists:
-        latest_releases = {
-            "items": []
-        }
-        for group in ["album", "single", "appears_on", "compilation"]:
-            try:
-                latest_items = sp.artist_albums(
-                    artist.id, include_groups=group, limit=5
-                )
-            except requests.exceptions.ConnectionError as e:
-                logging.error(f"Error fetching {group}s for {artist.name}: {e}")
-                continue
-            except requests.exceptions.ReadTimeout as e:
-                logging.error(f"Timeout error fetching {group}s for {artist.name}: {e}")
-                continue
-            if latest_items["items"]:
-                latest_releases["items"].extend(latest_items["items"])
-            time.sleep(1.5)  # Add a delay to avoid hitting rate limits
-
-        if not latest_releases["items"]:
-            continue
-
-        for album in latest_releases["items"]:
-            release_date = album["release_date"]
-            if release_date >= yesterday:
-                new_releases.append(
-                    create_release_from_data(album, artist.name)
+    yesterday = (datetime.date.today() - datetime.timedelta(days=1)).isoformat()
+    limiter = RateLimiter(MAX_CONCURRENT_REQUESTS)
+    seen_album_ids = set()
+    async with create_spotify_http_client(sp) as client:
+        results = await asyncio.gather(
+            *(
+                fetch_artist_new_releases(
+                    client, limiter, artist, yesterday, seen_album_ids
                 )
-
-    return new_releases
+                for artist in artists
+            )
+        )
+    return [release for releases in results for release in releases]
 
 
 def send_message_to_discord(releases: list[Release]):
     webhook_url = os.getenv("DISCORD_WEBHOOK_URL")
     if not webhook_url:
-        logging.error("Discord webhook URL not set.")
+        log.error("Discord webhook URL not set.")
         return
 
     push_message_to_discord(webhook_url, releases)
 
 
+def create_embed_from_release(release: Release) -> dict:
+    return {
+        "title": f"New {release.release_type} from {release.artist_name}",
+        "description": release.release_date,
+        "url": release.spotify_url,
+    }
+
+
 def push_message_to_discord(webhook_url: str, releases: list[Release]):
-    headers = {"Content-Type": "application/json"}
-    for release in releases:
-        data = {
-            "content": f"New {release.release_date} from {release.artist_name}: {release.release_date} - {release.spotify_url}"
-        }
-        response = requests.post(webhook_url, headers=headers, data=json.dumps(data))
-        if response.status_code != 204:
-            logging.error(
-                f"Failed to send message to Discord: {response.status_code} - {response.text}"
-            )
-        else:
-            logging.info(
-                f"Message sent to Discord: {release.release_date} - {release.spotify_url}"
-            )
+    # Only retry 429s: the webhook POST is not idempotent, so a retried 5xx or
+    # read timeout could post a batch Discord already accepted.
+    retry = Retry(
+        total=5,
+        read=0,
+        backoff_factor=0.5,
+        status_forcelist=[429],
+        allowed_methods=None,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    dumps = orjson.dumps
+    with create_session(retry) as session:
+        session.headers.update({"Content-Type": "application/json"})
+        for chunk in itertools.batched(releases, MAX_EMBEDS_PER_MESSAGE):
+            data = {"embeds": [create_embed_from_release(release) for release in chunk]}
+            try:
+                response = session.post(webhook_url, data=dumps(data))
+            except requests.RequestException as e:
+                log.error("Failed to send message to Discord: %s", e)
+                continue
+            if response.status_code != 204:
+                log.error(
+                    "Failed to send message to Discord: %s - %s",
+                    response.status_code,
+                    response.text,
+                )
+            else:
+                for release in chunk:
+                    log.info(
+                        "Message sent to Discord: %s - %s",
+                        release.release_date,
+                        release.spotify_url,
+                    )
 
 
 def main():
@@ -232,27 +439,27 @@ def main():
     artists = get_following_artists(sp)
 
     if not artists:
-        logging.info("No followed artists found.")
+        log.info("No followed artists found.")
         return
-    logging.info(f"Found {len(artists)} followed artists.")
+    log.info("Found %d followed artists.", len(artists))
 
-    logging.info("Checking for new releases...")
-    spotify_releases = get_following_artists_new_releases(sp)
+    log.info("Checking for new releases...")
+    spotify_releases = asyncio.run(get_following_artists_new_releases(sp, artists))
 
     if not spotify_releases:
-        logging.info("No recent releases found.")
+        log.info("No recent releases found.")
         return
 
-    releases_record = load_releases_from_file()
-    new_releases = []
-    for release in spotify_releases:
-        if not check_if_new_release(releases_record=releases_record, release=release):
-            continue
-        new_releases.append(release)
+    with closing(connect_releases_db()) as conn:
+        new_releases = [
+            release
+            for release in spotify_releases
+            if not is_known_release(conn, release.id)
+        ]
 
-    logging.info(f"Found {len(new_releases)} new releases.")
-    send_message_to_discord(new_releases)
-    add_new_releases_to_file(new_releases)
+        log.info("Found %d new releases.", len(new_releases))
+        send_message_to_discord(new_releases)
+        add_releases_to_db(conn, new_releases)
 
 
 if __name__ == "__main__":